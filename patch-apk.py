@@ -1,12 +1,36 @@
 #!/usr/bin/python3
 import argparse
+import concurrent.futures
+import contextlib
+import functools
+import itertools
 import os
-import pkg_resources
+import re
 import shutil
 import subprocess
 import sys
 import tempfile
-import xml.etree.ElementTree
+import zipfile
+try:
+	from packaging.version import Version
+except ImportError:
+	print("Error, the Python 'packaging' module is required, install it with 'pip install packaging'.")
+	sys.exit(1)
+try:
+	from lxml import etree as ET
+except ImportError:
+	import xml.etree.ElementTree as ET
+
+#The keystore used to sign rebuilt APKs
+KEYSTORE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data", "patch-apk.keystore")
+
+#Matches apktool's placeholder names for resources that are only named in a split APK
+DUMMY_NAME_RE = re.compile(rb"APKTOOL_DUMMY_\w+")
+
+#Printed after each command run through the persistent adb shell to mark the end of its output,
+#followed by the command's exit status
+ADB_SHELL_END_MARKER = "__PATCH_APK_END__"
+ADB_SHELL_END_RE = re.compile(re.escape(ADB_SHELL_END_MARKER) + r"(\d+)\s*$")
 
 ####################
 # Main()
@@ -24,10 +48,14 @@ def main():
 	#Get the APK path(s) from the device
 	apkpaths = getAPKPathsForPackage(pkgname)
 	
+	#Split APKs have user-installed CA cert support added while they're being combined, unless an
+	#unpatched copy of the APK is to be saved, in which case it's added after saving as for single APKs
+	combineUserCerts = args.no_enable_user_certs == False and args.save_apk is None
+	
 	#Create a temp directory to work from
-	with tempfile.TemporaryDirectory() as tmppath:
+	with tempWorkingDirectory() as tmppath:
 		#Get the APK to patch. Combine app bundles/split APKs into a single APK.
-		apkfile = getTargetAPK(pkgname, apkpaths, tmppath, args.disable_styles_hack)
+		apkfile = getTargetAPK(pkgname, apkpaths, tmppath, args.disable_styles_hack, combineUserCerts)
 		
 		#Save the APK if requested
 		if args.save_apk is not None:
@@ -38,27 +66,28 @@ def main():
 		#Patch the target APK with objection
 		print("Patching " + apkfile.split(os.sep)[-1] + " with objection.")
 		ret = None
-		if getObjectionVersion() >= pkg_resources.parse_version("1.9.3"):
+		if getObjectionVersion() >= Version("1.9.3"):
 			ret = subprocess.run(["objection", "patchapk", "--skip-resources", "--ignore-nativelibs", "-s", apkfile], stdout=getStdout())
 		else:
 			ret = subprocess.run(["objection", "patchapk", "--skip-resources", "-s", apkfile], stdout=getStdout())
 		if ret.returncode != 0:
 			print("Error: Failed to run 'objection patchapk --skip-resources -s " + apkfile + "'.\nRun with --debug-output for more information.")
 			sys.exit(1)
-		os.remove(apkfile)
-		shutil.move(apkfile[:-4] + ".objection.apk", apkfile)
+		os.replace(apkfile[:-4] + ".objection.apk", apkfile)
 		print("")
 		
 		#Enable support for user-installed CA certs (e.g. Burp Suite CA installed on device by user)
-		if args.no_enable_user_certs == False:
+		if args.no_enable_user_certs == False and (len(apkpaths) == 1 or combineUserCerts == False):
 			enableUserCerts(apkfile)
 		
 		#Uninstall the original package from the device
 		print("Uninstalling the original package from the device.")
-		ret = subprocess.run(["adb", "uninstall", pkgname], stdout=getStdout())
+		ret = runAdbShell("pm uninstall " + pkgname)
+		dbgPrint(ret.stdout.strip())
 		if ret.returncode != 0:
-			print("Error: Failed to run 'adb uninstall " + pkgname + "'.\nRun with --debug-output for more information.")
+			print("Error: Failed to run 'adb shell pm uninstall " + pkgname + "'.\nRun with --debug-output for more information.")
 			sys.exit(1)
+		closeAdbShell()
 		print("")
 		
 		#Install the patched APK
@@ -89,18 +118,17 @@ def checkDependencies():
 		sys.exit(1)
 	
 	#Verify that an Android device is connected
-	proc = subprocess.run(["adb", "devices"], stdout=subprocess.PIPE)
+	proc = subprocess.run(["adb", "devices"], stdout=subprocess.PIPE, text=True)
 	if proc.returncode != 0:
 		print("Error: Failed to run 'adb devices'.")
 		sys.exit(1)
-	deviceOut = proc.stdout.decode("utf-8")
-	if len(deviceOut.strip().split(os.linesep)) == 1:
+	if len(proc.stdout.strip().splitlines()) == 1:
 		print("Error, no Android device connected (\"adb devices\"), connect a device first.")
 		sys.exit(1)
 	
 	#Check that the included keystore exists
-	if os.path.exists(os.path.realpath(os.path.join(os.path.realpath(__file__), "..", "data", "patch-apk.keystore"))) == False:
-		print("Error, the keystore was not found at " + os.path.realpath(os.path.join(os.path.realpath(__file__), "..", "data", "patch-apk.keystore")) + ", please clone the repository or get the keystore file and place it at this location.")
+	if os.path.exists(KEYSTORE_PATH) == False:
+		print("Error, the keystore was not found at " + KEYSTORE_PATH + ", please clone the repository or get the keystore file and place it at this location.")
 		sys.exit(1)
 
 ####################
@@ -117,6 +145,7 @@ def getArgs():
 		parser.add_argument("--save-apk", help="Save a copy of the APK (or single APK) prior to patching for use with other tools.")
 		parser.add_argument("--disable-styles-hack", help="Disable the styles hack that removes duplicate entries from res/values/styles.xml.", action="store_true")
 		parser.add_argument("--debug-output", help="Enable debug output.", action="store_true")
+		parser.add_argument("--jobs", help="Maximum number of split APKs to extract, and resource files to update, in parallel (default: number of CPUs).", type=positiveInt, default=os.cpu_count() or 1)
 		parser.add_argument("pkgname", help="The name, or partial name, of the package to patch (e.g. com.foo.bar).")
 		
 		#Store the parsed args
@@ -125,6 +154,18 @@ def getArgs():
 	#Return the parsed command line args
 	return getArgs.parsed_args
 
+####################
+# argparse type for options that take a count of one or more
+####################
+def positiveInt(value):
+	try:
+		count = int(value)
+	except ValueError:
+		raise argparse.ArgumentTypeError("invalid int value: '" + value + "'")
+	if count < 1:
+		raise argparse.ArgumentTypeError("must be at least 1")
+	return count
+
 ####################
 # Debug print
 ####################
@@ -134,7 +175,9 @@ def dbgPrint(msg):
 
 ####################
 # Get the stdout target for subprocess calls. Set to DEVNULL unless debug output is enabled.
+# The result is cached as the command line args don't change.
 ####################
+@functools.lru_cache(maxsize=None)
 def getStdout():
 	if getArgs().debug_output == True:
 		return None
@@ -142,25 +185,29 @@ def getStdout():
 		return subprocess.DEVNULL
 
 ####################
-# Get objection version
+# Get objection version (cached, the objection process is only run once)
 ####################
+@functools.lru_cache(maxsize=None)
 def getObjectionVersion():
-	proc = subprocess.run(["objection", "version"], stdout=subprocess.PIPE)
-	return pkg_resources.parse_version(proc.stdout.decode("utf-8").strip().split(": ")[-1].strip())
+	proc = subprocess.run(["objection", "version"], stdout=subprocess.PIPE, text=True)
+	return Version(proc.stdout.strip().split(": ")[-1].strip())
 
 ####################
-# Get apktool version
+# Get apktool version (cached, apktool starts a JVM so is only run once)
 ####################
+@functools.lru_cache(maxsize=None)
 def getApktoolVersion():
 	output = ""
 	if os.name == "nt":
-		proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-		proc.communicate(b"\r\n")
-		output = proc.stdout.decode("utf-8").strip()
+		#Same dirty hack as runApkTool to get past the "pause" in apktool.bat
+		proc = subprocess.Popen(["apktool.bat", "-version"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+		output = proc.communicate("\r\n")[0].strip()
 	else:
-		proc = subprocess.run(["apktool", "-version"], stdout=subprocess.PIPE)
-		output = proc.stdout.decode("utf-8").strip()
-	return pkg_resources.parse_version(output.split("-")[0].strip())
+		proc = subprocess.run(["apktool", "-version"], stdout=subprocess.PIPE, text=True)
+		output = proc.stdout.strip()
+	
+	#Only the first line holds the version, apktool.bat prints its "pause" prompt after it
+	return Version(output.splitlines()[0].split("-")[0].strip())
 
 ####################
 # Wrapper to run apktool platform-independently, complete with a dirty hack to fix apktool's dirty hack.
@@ -179,6 +226,68 @@ def runApkTool(params):
 		args.extend(params)
 		return subprocess.run(args, stdout=getStdout())
 
+####################
+# Create a temp directory to work from and remove it again afterwards.
+# apktool output trees contain tens of thousands of files, so on POSIX systems removal is
+# handed to a detached "rm -rf" instead of making the user wait for shutil.rmtree.
+####################
+@contextlib.contextmanager
+def tempWorkingDirectory():
+	tmppath = tempfile.mkdtemp()
+	try:
+		yield tmppath
+	finally:
+		if os.name == "nt":
+			shutil.rmtree(tmppath, ignore_errors=True)
+		else:
+			subprocess.Popen(["rm", "-rf", tmppath], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+####################
+# Run a command on the device through a persistent "adb shell" session.
+# The session is started on first use and reused by later commands to avoid
+# paying the adb connection setup for every command. Returns a CompletedProcess
+# holding the command's exit status and output.
+####################
+def runAdbShell(command):
+	#Only start the shell once
+	if not hasattr(runAdbShell, "proc"):
+		runAdbShell.proc = subprocess.Popen(["adb", "shell"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+	
+	#Run the command followed by an end marker holding the exit status. The marker is split in
+	#two quoted halves so that shells which echo their input (older devices without the adb
+	#shell v2 protocol) don't echo back a line that looks like the marker.
+	runAdbShell.proc.stdin.write(command + "; echo \"" + ADB_SHELL_END_MARKER[:12] + "\"\"" + ADB_SHELL_END_MARKER[12:] + "$?\"\n")
+	runAdbShell.proc.stdin.flush()
+	
+	#Read output up to the end marker
+	output = []
+	returncode = 1
+	while True:
+		line = runAdbShell.proc.stdout.readline()
+		if line == "":
+			#The shell exited unexpectedly (e.g. device disconnected)
+			break
+		
+		#Output that doesn't end in a newline leaves the marker part way along the last line
+		marker = ADB_SHELL_END_RE.search(line)
+		if marker is not None:
+			output.append(line[:marker.start()])
+			returncode = int(marker.group(1))
+			break
+		output.append(line)
+	return subprocess.CompletedProcess(["adb", "shell", command], returncode, "".join(output))
+
+####################
+# Close the persistent "adb shell" session, if one was started.
+####################
+def closeAdbShell():
+	if hasattr(runAdbShell, "proc"):
+		runAdbShell.proc.stdin.write("exit\n")
+		runAdbShell.proc.stdin.close()
+		runAdbShell.proc.wait()
+		runAdbShell.proc.stdout.close()
+		del runAdbShell.proc
+
 ####################
 # Verify the package name - checks whether the target package is installed
 # on the device or if an exact match is not found presents the options to
@@ -187,15 +296,15 @@ def runApkTool(params):
 def verifyPackageName(pkgname):
 	#Get a list of installed packages matching the given name
 	packages = []
-	proc = subprocess.run(["adb", "shell", "pm", "list", "packages"], stdout=subprocess.PIPE)
+	proc = runAdbShell("pm list packages")
 	if proc.returncode != 0:
 		print("Error: Failed to run 'adb shell pm list packages'.")
 		sys.exit(1)
-	out = proc.stdout.decode("utf-8")
-	for line in out.split(os.linesep):
+	search = pkgname.lower()
+	for line in proc.stdout.splitlines():
 		if line.startswith("package:"):
 			line = line[8:].strip()
-			if pkgname.lower() in line.lower():
+			if search in line.lower():
 				packages.append(line)
 	
 	#Bail out if no matching packages were found
@@ -209,16 +318,21 @@ def verifyPackageName(pkgname):
 		return packages[0]
 	else:
 		print("Multiple matching packages installed, select the package to patch.")
+		for i in range(len(packages)):
+			print("[" + str(i + 1) + "] " + packages[i])
 		choice = -1
 		while choice == -1:
-			for i in range(len(packages)):
-				print("[" + str(i + 1) + "] " + packages[i])
 			choice = input("Choice: ")
-			if choice.isnumeric() == False or int(choice) < 1 or int(choice) > len(packages):
-				print("Invalid choice.\n")
+			if choice.isnumeric() == False:
 				choice = -1
+			else:
+				choice = int(choice)
+				if choice < 1 or choice > len(packages):
+					choice = -1
+			if choice == -1:
+				print("Invalid choice.\n")
 		print("")
-		return packages[int(choice) - 1]
+		return packages[choice - 1]
 
 ####################
 # Get the APK path(s) on the device for the given package name.
@@ -226,12 +340,11 @@ def verifyPackageName(pkgname):
 def getAPKPathsForPackage(pkgname):
 	print("Getting APK path(s) for package: " + pkgname)
 	paths = []
-	proc = subprocess.run(["adb", "shell", "pm", "path", pkgname], stdout=subprocess.PIPE)
+	proc = runAdbShell("pm path " + pkgname)
 	if proc.returncode != 0:
 		print("Error: Failed to run 'adb shell pm path " + pkgname + "'.")
 		sys.exit(1)
-	out = proc.stdout.decode("utf-8")
-	for line in out.split(os.linesep):
+	for line in proc.stdout.splitlines():
 		if line.startswith("package:"):
 			line = line[8:].strip()
 			print("[+] APK path: " + line)
@@ -239,59 +352,113 @@ def getAPKPathsForPackage(pkgname):
 	print("")
 	return paths
 
+####################
+# Get the sizes in bytes of files on the device. Returns a dict mapping each path to its size,
+# or an empty dict if the sizes couldn't be read.
+####################
+def getRemoteFileSizes(paths):
+	proc = runAdbShell("stat -c %s '" + "' '".join(paths) + "' 2>/dev/null")
+	sizes = proc.stdout.split()
+	if proc.returncode != 0 or len(sizes) != len(paths) or not all(size.isdigit() for size in sizes):
+		dbgPrint("[~] Failed to read APK file sizes from the device, pulling in the original order.")
+		return {}
+	return dict(zip(paths, map(int, sizes)))
+
 ####################
 # Pull the APK file(s) for the package and return the local file path to work with.
 # If the package is an app bundle/split APK, combine the APKs into a single APK.
 ####################
-def getTargetAPK(pkgname, apkpaths, tmppath, disableStylesHack):
-	#Pull the APKs from the device
+def getTargetAPK(pkgname, apkpaths, tmppath, disableStylesHack, userCerts):
+	#Pull the APKs from the device. Split APKs are handed to the extraction pool as soon as each
+	#pull completes so that extracting them with apktool overlaps with the remaining pulls.
 	print("Pulling APK file(s) from device.")
 	localapks = []
+	extractions = {}
+	
 	for remotepath in apkpaths:
-		baseapkname = remotepath.split('/')[-1]
-		localapks.append(os.path.join(tmppath, pkgname + "-" + baseapkname))
-		print("[+] Pulling: " + pkgname + "-" + baseapkname)
-		ret = subprocess.run(["adb", "pull", remotepath, localapks[-1]], stdout=getStdout())
-		if ret.returncode != 0:
-			print("Error: Failed to run 'adb pull " + remotepath + " " + localapks[-1] + "'.\nRun with --debug-output for more information.")
-			sys.exit(1)
-	print("")
+		localapks.append(os.path.join(tmppath, pkgname + "-" + remotepath.split('/')[-1]))
+	
+	#Handle the largest split APKs first, they take longest to pull and extract so starting them
+	#early keeps them from being the last to finish while the other workers sit idle. Only the
+	#scheduling changes, localapks keeps the "pm path" order that split APKs are merged in.
+	pullorder = list(zip(apkpaths, localapks))
+	if len(apkpaths) > 1:
+		sizes = getRemoteFileSizes(apkpaths)
+		pullorder.sort(key=lambda paths: sizes.get(paths[0], 0), reverse=True)
+	extractExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=min(len(apkpaths), getArgs().jobs))
+	try:
+		#Cap concurrent pulls, they all share the one adb server and USB connection
+		with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(apkpaths), 8)) as pullExecutor:
+			pulls = {}
+			for (remotepath, localapk) in pullorder:
+				print("[+] Pulling: " + os.path.basename(localapk))
+				pulls[pullExecutor.submit(subprocess.run, ["adb", "pull", remotepath, localapk], stdout=getStdout())] = (remotepath, localapk)
+			for pull in concurrent.futures.as_completed(pulls):
+				(remotepath, localapk) = pulls[pull]
+				if pull.result().returncode != 0:
+					print("Error: Failed to run 'adb pull " + remotepath + " " + localapk + "'.\nRun with --debug-output for more information.")
+					sys.exit(1)
+				if len(apkpaths) > 1:
+					#Check for ProGuard/AndResGuard - this might b0rk decompile/recompile
+					if detectProGuard(localapk):
+						print("[~] WARNING: Detected ProGuard/AndResGuard in " + localapk + ", decompile/recompile may not succeed.")
+					extractions[localapk] = extractExecutor.submit(extractApk, localapk)
+		print("")
+		
+		#Return the target APK path
+		if len(localapks) == 1:
+			return localapks[0]
+		print("App bundle/split APK detected, rebuilding as a single APK.")
+		print("")
+		
+		#Wait for the individual APKs to be extracted
+		print("Extracting individual APKs with apktool.")
+		for apkpath in localapks:
+			print("[+] Extracting: " + apkpath)
+			ret = extractions[apkpath].result()
+			if ret is not None and ret.returncode != 0:
+				print("Error: Failed to run 'apktool d " + apkpath + " -o " + apkpath[:-4] + "'.\nRun with --debug-output for more information.")
+				sys.exit(1)
+		print("")
+	finally:
+		#Drop any extractions that haven't started yet, so an error or Ctrl-C doesn't leave
+		#apktool decoding the remaining split APKs before the process can exit
+		extractExecutor.shutdown(cancel_futures=True)
 	
-	#Return the target APK path
-	if len(localapks) == 1:
-		return localapks[0]
-	else:
-		#Combine split APKs
-		return combineSplitAPKs(pkgname, localapks, tmppath, disableStylesHack)
+	#Combine split APKs
+	return combineSplitAPKs(pkgname, localapks, tmppath, disableStylesHack, userCerts)
 
 ####################
-# Combine app bundles/split APKs into a single APK for patching.
+# Extract an APK with apktool into a directory alongside the APK file. Returns the apktool
+# process, or None if apktool wasn't needed.
 ####################
-def combineSplitAPKs(pkgname, localapks, tmppath, disableStylesHack):
-	print("App bundle/split APK detected, rebuilding as a single APK.")
-	print("")
+def extractApk(apkpath):
+	params = ["d", apkpath, "-o", apkpath[:-4]]
+	
+	#Split APKs that only hold files (e.g. native libraries) don't need apktool at all, unzip them directly
+	if apkpath.endswith("base.apk") == False and isFilesOnlyApk(apkpath) == True:
+		dbgPrint("[+] " + apkpath + " only contains lib/ and assets/ files, extracting with zipfile.")
+		extractFilesOnlyApk(apkpath, apkpath[:-4])
+		return None
 	
-	#Extract the individual APKs
-	print("Extracting individual APKs with apktool.")
+	#Skip resource decoding for split APKs that don't have a resource table (e.g. native library splits)
+	if apkpath.endswith("base.apk") == False and hasResourceTable(apkpath) == False:
+		dbgPrint("[+] No resources.arsc in " + apkpath + ", extracting with 'apktool d -r'.")
+		params.insert(1, "-r")
+	return runApkTool(params)
+
+####################
+# Combine app bundles/split APKs into a single APK for patching.
+# The individual APKs have already been extracted alongside the APK files by getTargetAPK.
+####################
+def combineSplitAPKs(pkgname, localapks, tmppath, disableStylesHack, userCerts):
+	#Record the destination paths of all but the base APK
 	baseapkdir = os.path.join(tmppath, pkgname + "-base")
 	baseapkfilename = pkgname + "-base.apk"
 	splitapkpaths = []
 	for apkpath in localapks:
-		print("[+] Extracting: " + apkpath)
-		apkdir = apkpath[:-4]
-		ret = runApkTool(["d", apkpath, "-o", apkdir])
-		if ret.returncode != 0:
-			print("Error: Failed to run 'apktool d " + apkpath + " -o " + apkdir + "'.\nRun with --debug-output for more information.")
-			sys.exit(1)
-		
-		#Record the destination paths of all but the base APK
 		if apkpath.endswith("base.apk") == False:
-			splitapkpaths.append(apkdir)
-		
-		#Check for ProGuard/AndResGuard - this might b0rk decompile/recompile
-		if detectProGuard(apkdir):
-			print("\n[~] WARNING: Detected ProGuard/AndResGuard, decompile/recompile may not succeed.\n")
-	print("")
+			splitapkpaths.append(apkpath[:-4])
 	
 	#Walk the extracted APK directories and copy files and directories to the base APK
 	copySplitApkFiles(baseapkdir, splitapkpaths)
@@ -306,6 +473,13 @@ def combineSplitAPKs(pkgname, localapks, tmppath, disableStylesHack):
 	#Disable APK splitting in the base AndroidManifest.xml file
 	disableApkSplitting(baseapkdir)
 	
+	#Enable support for user-installed CA certs while the base APK is extracted, saves enableUserCerts
+	#having to extract and rebuild the combined APK again later
+	if userCerts == True:
+		print("Patching APK to enable support for user-installed CA certificates.")
+		addNetworkSecurityConfig(baseapkdir)
+		print("")
+	
 	#Rebuild the base APK
 	print("Rebuilding as a single APK.")
 	if os.path.exists(os.path.join(baseapkdir, "res", "navigation")) == True:
@@ -314,7 +488,7 @@ def combineSplitAPKs(pkgname, localapks, tmppath, disableStylesHack):
 		if ret.returncode != 0:
 			print("Error: Failed to run 'apktool b " + baseapkdir + "'.\nRun with --debug-output for more information.")
 			sys.exit(1)
-	elif getApktoolVersion() > pkg_resources.parse_version("2.4.2"):
+	elif getApktoolVersion() > Version("2.4.2"):
 		print("[+] Found apktool version > 2.4.2, rebuilding with 'apktool --use-aapt2'.")
 		ret = runApkTool(["--use-aapt2", "b", baseapkdir])
 		if ret.returncode != 0:
@@ -329,83 +503,149 @@ def combineSplitAPKs(pkgname, localapks, tmppath, disableStylesHack):
 	
 	
 	#Sign the new APK
+	builtapk = os.path.join(baseapkdir, "dist", baseapkfilename)
+	alignedapk = os.path.join(baseapkdir, "dist", baseapkfilename[:-4] + "-aligned.apk")
 	print("[+] Signing new APK.")
 	ret = subprocess.run([
 			"jarsigner", "-sigalg", "SHA1withRSA", "-digestalg", "SHA1", "-keystore",
-			os.path.realpath(os.path.join(os.path.realpath(__file__), "..", "data", "patch-apk.keystore")),
-			"-storepass", "patch-apk", os.path.join(baseapkdir, "dist", baseapkfilename), "patch-apk-key"],
+			KEYSTORE_PATH,
+			"-storepass", "patch-apk", builtapk, "patch-apk-key"],
 		stdout=getStdout()
 	)
 	if ret.returncode != 0:
 		print("Error: Failed to run 'jarsigner -sigalg SHA1withRSA -digestalg SHA1 -keystore " +
-			os.path.realpath(os.path.join(os.path.realpath(__file__), "..", "data", "patch-apk.keystore")) +
-			"-storepass patch-apk " + os.path.join(baseapkdir, "dist", baseapkfilename) + " patch-apk-key'.\nRun with --debug-output for more information.")
+			KEYSTORE_PATH +
+			"-storepass patch-apk " + builtapk + " patch-apk-key'.\nRun with --debug-output for more information.")
 		sys.exit(1)
 
 	
 	#Zip align the new APK
 	print("[+] Zip aligning new APK.")
-	ret = subprocess.run([
-			"zipalign", "-f", "4", os.path.join(baseapkdir, "dist", baseapkfilename),
-			os.path.join(baseapkdir, "dist", baseapkfilename[:-4] + "-aligned.apk")
-		],
-		stdout=getStdout()
-	)
+	ret = subprocess.run(["zipalign", "-p", "-f", "4", builtapk, alignedapk], stdout=getStdout())
 	if ret.returncode != 0:
-		print("Error: Failed to run 'zipalign -f 4 " + os.path.join(baseapkdir, "dist", baseapkfilename) +
-			" " + os.path.join(baseapkdir, "dist", baseapkfilename[:-4] + "-aligned.apk") + "'.\nRun with --debug-output for more information.")
+		print("Error: Failed to run 'zipalign -p -f 4 " + builtapk + " " + alignedapk + "'.\nRun with --debug-output for more information.")
 		sys.exit(1)
-	shutil.move(os.path.join(baseapkdir, "dist", baseapkfilename[:-4] + "-aligned.apk"), os.path.join(baseapkdir, "dist", baseapkfilename))
+	os.replace(alignedapk, builtapk)
 	print("")
 	
 	#Return the new APK path
-	return os.path.join(baseapkdir, "dist", baseapkfilename)
+	return builtapk
+
+####################
+# Check whether an APK contains a compiled resource table (resources.arsc).
+####################
+def hasResourceTable(apkpath):
+	with zipfile.ZipFile(apkpath) as zf:
+		return "resources.arsc" in zf.namelist()
+
+####################
+# Check whether an APK contains nothing but plain files that apktool would copy as-is, i.e. it
+# only has lib/, assets/, and META-INF/ entries alongside the AndroidManifest.xml.
+####################
+def isFilesOnlyApk(apkpath):
+	with zipfile.ZipFile(apkpath) as zf:
+		for name in zf.namelist():
+			if name != "AndroidManifest.xml" and name.split("/")[0] not in ["lib", "assets", "META-INF"]:
+				return False
+	return True
+
+####################
+# Extract a files-only APK (see isFilesOnlyApk) using the same layout as "apktool d", without
+# starting apktool. META-INF goes to original/ and the binary AndroidManifest.xml is skipped as
+# split APK manifests are never merged into the base APK.
+####################
+def extractFilesOnlyApk(apkpath, apkdir):
+	with zipfile.ZipFile(apkpath) as zf:
+		for info in zf.infolist():
+			if info.filename == "AndroidManifest.xml":
+				continue
+			if info.filename.startswith("META-INF/"):
+				zf.extract(info, os.path.join(apkdir, "original"))
+			else:
+				zf.extract(info, apkdir)
 
 ####################
 # Attempt to detect ProGuard/AndResGuard.
+# Reads META-INF straight from the APK file so this can be checked before extraction.
+####################
+def detectProGuard(apkpath):
+	with zipfile.ZipFile(apkpath) as zf:
+		names = zf.namelist()
+		for name in names:
+			if name == "META-INF/proguard" or name.startswith("META-INF/proguard/"):
+				return True
+		if "META-INF/MANIFEST.MF" in names:
+			with zf.open("META-INF/MANIFEST.MF") as fh:
+				if streamContains(fh, b"proguard") == True:
+					return True
+	return False
+
 ####################
-def detectProGuard(extractedPath):
-	if os.path.exists(os.path.join(extractedPath, "original", "META-INF", "proguard")) == True:
-		return True
-	if os.path.exists(os.path.join(extractedPath, "original", "META-INF", "MANIFEST.MF")) == True:
-		fh = open(os.path.join(extractedPath, "original", "META-INF", "MANIFEST.MF"))
-		d = fh.read()
-		fh.close()
-		if "proguard" in d.lower():
+# Case-insensitively search a binary file object for the given lower case string.
+# Reads in chunks and stops at the first match rather than loading the whole file.
+####################
+def streamContains(fh, needle):
+	tail = b""
+	while True:
+		chunk = fh.read(65536)
+		if len(chunk) == 0:
+			return False
+		
+		#Keep the end of the previous chunk so matches spanning two chunks are found
+		data = tail + chunk.lower()
+		if needle in data:
 			return True
-	return False
+		tail = data[-(len(needle) - 1):]
 
 ####################
 # Copy files and directories from split APKs into the base APK directory.
 ####################
 def copySplitApkFiles(baseapkdir, splitapkpaths):
 	print("Copying files and directories from split APKs into base APK.")
+	resdir = os.sep + "res"
 	for apkdir in splitapkpaths:
 		for (root, dirs, files) in os.walk(apkdir):
+			#Translate the directory path to the base APK path once for all of its entries
+			relroot = root[len(apkdir):]
+			baseroot = baseapkdir + relroot
+			isResDir = relroot == resdir or relroot.startswith(resdir + os.sep)
+			
 			#Skip the original files directory
-			if root.startswith(os.path.join(apkdir, "original")) == False:
-				#Create any missing directories
-				for d in dirs:
-					#Translate directory path to base APK path and create the directory if it doesn't exist
-					p = baseapkdir + os.path.join(root, d)[len(apkdir):]
-					if os.path.exists(p) == False:
-						dbgPrint("[+] Creating directory in base APK: " + p[len(baseapkdir):])
-						os.mkdir(p)
+			if root == apkdir and "original" in dirs:
+				dirs.remove("original")
+			
+			#Create any missing directories
+			for d in list(dirs):
+				p = os.path.join(baseroot, d)
+				
+				#Directories outside of res that the base APK doesn't have (e.g. lib/arm64-v8a) are
+				#moved over whole, in one rename, rather than file by file
+				if isResDir == False and relroot + os.sep + d != resdir and os.path.exists(p) == False:
+					dbgPrint("[+] Moving directory to base APK: " + relroot + os.sep + d)
+					os.rename(os.path.join(root, d), p)
+					dirs.remove(d)
+					continue
+				
+				#Create the directory in the base APK if it doesn't exist
+				try:
+					os.mkdir(p)
+					dbgPrint("[+] Created directory in base APK: " + relroot + os.sep + d)
+				except FileExistsError:
+					pass
+			
+			#Copy files into the base APK
+			for f in files:
+				#Skip the AndroidManifest.xml and apktool.yml in the APK root directory
+				if apkdir == root and (f == "AndroidManifest.xml" or f == "apktool.yml"):
+					continue
 				
-				#Copy files into the base APK
-				for f in files:
-					#Skip the AndroidManifest.xml and apktool.yml in the APK root directory
-					if apkdir == root and (f == "AndroidManifest.xml" or f == "apktool.yml"):
-						continue
-					
-					#Translate path to base APK
-					p = baseapkdir + os.path.join(root, f)[len(apkdir):]
-					
-					#Copy files into the base APK, except for XML files in the res directory
-					if f.lower().endswith(".xml") and p.startswith(os.path.join(baseapkdir, "res")):
-						continue
-					dbgPrint("[+] Moving file to base APK: " + p[len(baseapkdir):])
-					shutil.move(os.path.join(root, f), p)
+				#Copy files into the base APK, except for XML files in the res directory
+				if isResDir and f.lower().endswith(".xml"):
+					continue
+				
+				#Everything lives under the same temp directory so a rename is enough
+				dbgPrint("[+] Moving file to base APK: " + relroot + os.sep + f)
+				os.replace(os.path.join(root, f), os.path.join(baseroot, f))
 	print("")
 
 ####################
@@ -416,7 +656,8 @@ def copySplitApkFiles(baseapkdir, splitapkpaths):
 ####################
 def fixPublicResourceIDs(baseapkdir, splitapkpaths):
 	#Bail if the base APK does not have a public.xml
-	if os.path.exists(os.path.join(baseapkdir, "res", "values", "public.xml")) == False:
+	publicxml = os.path.join(baseapkdir, "res", "values", "public.xml")
+	if os.path.exists(publicxml) == False:
 		return
 	print("Found public.xml in the base APK, fixing resource identifiers across split APKs.")
 	
@@ -427,7 +668,7 @@ def fixPublicResourceIDs(baseapkdir, splitapkpaths):
 	#Step 1) Find all resource IDs that apktool has assigned a name of APKTOOL_DUMMY_XXX to.
 	#        Load these into the lookup tables ready to resolve the real resource names from
 	#        the split APKs in step 2 below.
-	baseXmlTree = xml.etree.ElementTree.parse(os.path.join(baseapkdir, "res", "values", "public.xml"))
+	baseXmlTree = ET.parse(publicxml)
 	for el in baseXmlTree.getroot():
 		if "name" in el.attrib and "id" in el.attrib:
 			if el.attrib["name"].startswith("APKTOOL_DUMMY_") and el.attrib["name"] not in idToDummyName:
@@ -441,8 +682,9 @@ def fixPublicResourceIDs(baseapkdir, splitapkpaths):
 	#        the base APK.
 	found = 0
 	for splitdir in splitapkpaths:
-		if os.path.exists(os.path.join(splitdir, "res", "values", "public.xml")):
-			tree = xml.etree.ElementTree.parse(os.path.join(splitdir, "res", "values", "public.xml"))
+		splitpublicxml = os.path.join(splitdir, "res", "values", "public.xml")
+		if os.path.exists(splitpublicxml):
+			tree = ET.parse(splitpublicxml)
 			for el in tree.getroot():
 				if "name" in el.attrib and "id" in el.attrib:
 					if el.attrib["id"] in idToDummyName:
@@ -458,56 +700,86 @@ def fixPublicResourceIDs(baseapkdir, splitapkpaths):
 			if el.attrib["name"] in dummyNameToRealName and dummyNameToRealName[el.attrib["name"]] is not None:
 				el.attrib["name"] = dummyNameToRealName[el.attrib["name"]]
 				updated += 1
-	baseXmlTree.write(os.path.join(baseapkdir, "res", "values", "public.xml"), encoding="utf-8", xml_declaration=True)
+	baseXmlTree.write(publicxml, encoding="utf-8", xml_declaration=True)
 	print("[+] Updated " + str(updated) + " dummy resource names with true names in the base APK.")
 	
 	#Step 4) Find all references to APKTOOL_DUMMY_XXX resources within other XML resource files
 	#        in the base APK and update them to refer to the true resource name.
 	updated = 0
-	for (root, dirs, files) in os.walk(os.path.join(baseapkdir, "res")):
-		for f in files:
-			if f.lower().endswith(".xml"):
-				try:
-					#Load the XML
-					dbgPrint("[~] Parsing " + os.path.join(root, f))
-					tree = xml.etree.ElementTree.parse(os.path.join(root, f))
-					
-					#Register the namespaces and get the prefix for the "android" namespace
-					namespaces = dict([node for _,node in xml.etree.ElementTree.iterparse(os.path.join(baseapkdir, "AndroidManifest.xml"), events=["start-ns"])])
-					for ns in namespaces:
-						xml.etree.ElementTree.register_namespace(ns, namespaces[ns])
-					ns = "{" + namespaces["android"] + "}"
-					
-					#Update references to APKTOOL_DUMMY_XXX resources
-					changed = False
-					for el in tree.iter():
-						#Check for references to APKTOOL_DUMMY_XXX resources in attributes of this element
-						for attr in el.attrib:
-							val = el.attrib[attr]
-							if val.startswith("@") and "/" in val and val.split("/")[1].startswith("APKTOOL_DUMMY_") and dummyNameToRealName[val.split("/")[1]] is not None:
-								el.attrib[attr] = val.split("/")[0] + "/" + dummyNameToRealName[val.split("/")[1]]
-								updated += 1
-								changed = True
-							elif val.startswith("APKTOOL_DUMMY_") and dummyNameToRealName[val] is not None:
-								el.attrib[attr] = dummyNameToRealName[val]
-								updated += 1
-								changed = True
-						
-						#Check for references to APKTOOL_DUMMY_XXX resources in the element text
-						val = el.text
-						if val is not None and val.startswith("@") and "/" in val and val.split("/")[1].startswith("APKTOOL_DUMMY_") and dummyNameToRealName[val.split("/")[1]] is not None:
-							el.text = val.split("/")[0] + "/" + dummyNameToRealName[val.split("/")[1]]
-							updated += 1
-							changed = True
-					
-					#Save the file if it was updated
-					if changed == True:
-						tree.write(os.path.join(root, f), encoding="utf-8", xml_declaration=True)
-				except xml.etree.ElementTree.ParseError:
-					print("[-] XML parse error in " + os.path.join(root, f) + ", skipping.")
+	realNames = {}
+	for dummyName in dummyNameToRealName:
+		if dummyNameToRealName[dummyName] is not None:
+			realNames[dummyName.encode("utf-8")] = dummyNameToRealName[dummyName].encode("utf-8")
+	
+	#Nothing can be rewritten if none of the dummy resource names were resolved
+	if len(realNames) == 0:
+		print("[+] No dummy resource names to update in other resource files.")
+		print("")
+		return
+	xmlpaths = list(findXmlFiles(os.path.join(baseapkdir, "res")))
+	
+	#The files are independent of each other so spread the work across all CPU cores. Windows
+	#can't wait on more than 61 worker processes so the pool size is capped there.
+	workers = getArgs().jobs
+	if os.name == "nt":
+		workers = min(workers, 61)
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+		for (xmlpath, count) in zip(xmlpaths, executor.map(updateDummyReferences, xmlpaths, itertools.repeat(realNames), chunksize=32)):
+			if count > 0:
+				dbgPrint("[~] Updated " + xmlpath)
+				updated += count
 	print("[+] Updated " + str(updated) + " references to dummy resource names in the base APK.")
 	print("")
 
+####################
+# Recursively find all XML files beneath a directory.
+# Uses the file type information from os.scandir rather than building per-directory
+# lists of names as os.walk does.
+####################
+def findXmlFiles(dirpath):
+	with os.scandir(dirpath) as entries:
+		for entry in entries:
+			if entry.is_dir(follow_symlinks=False):
+				yield from findXmlFiles(entry.path)
+			elif entry.is_file() and entry.name.lower().endswith(".xml"):
+				yield entry.path
+
+####################
+# Update references to APKTOOL_DUMMY_XXX resources in a single XML file.
+# Runs in a worker process, returns the number of references updated.
+####################
+def updateDummyReferences(xmlpath, realNames):
+	#Load the raw XML and skip files without any dummy resource names
+	fh = open(xmlpath, "rb")
+	data = fh.read()
+	fh.close()
+	if b"APKTOOL_DUMMY_" not in data:
+		return 0
+	
+	#Update references to APKTOOL_DUMMY_XXX resources in attributes and element text
+	data, count = replaceDummyNames(data, realNames)
+	
+	#Save the file if it was updated
+	if count > 0:
+		fh = open(xmlpath, "wb")
+		fh.write(data)
+		fh.close()
+	return count
+
+####################
+# Replace APKTOOL_DUMMY_XXX resource names in raw XML data with their true names.
+# Returns the updated data and the number of names replaced.
+####################
+def replaceDummyNames(data, realNames):
+	count = 0
+	def replace(match):
+		nonlocal count
+		if match.group(0) in realNames:
+			count += 1
+			return realNames[match.group(0)]
+		return match.group(0)
+	return DUMMY_NAME_RE.sub(replace, data), count
+
 ####################
 # Hack to remove duplicate style resource entries before rebuilding.
 # 
@@ -522,23 +794,32 @@ def fixPublicResourceIDs(baseapkdir, splitapkpaths):
 ####################
 def hackRemoveDuplicateStyleEntries(baseapkdir):
 	#Bail if there is no styles.xml
-	if os.path.exists(os.path.join(baseapkdir, "res", "values", "styles.xml")) == False:
+	stylesxml = os.path.join(baseapkdir, "res", "values", "styles.xml")
+	if os.path.exists(stylesxml) == False:
 		return
 	print("Found styles.xml in the base APK, checking for duplicate <style> -> <item> elements and removing.")
 	print("[~] Warning: this is a complete hack and may impact the visuals of the app, disable with --disable-styles-hack.")
 	
+	#Stream through styles.xml and bail out early if there are no duplicates to remove
+	if hasDuplicateStyleEntries(stylesxml) == False:
+		print("")
+		return
+	
 	#Duplicates
 	dupes = []
 	
 	#Parse styles.xml and find all <item> elements with duplicate names
-	tree = xml.etree.ElementTree.parse(os.path.join(baseapkdir, "res", "values", "styles.xml"))
+	tree = ET.parse(stylesxml)
 	for styleEl in tree.getroot().findall("style"):
-		itemNames = []
-		for itemEl in styleEl:
-			if "name" in itemEl.attrib and itemEl.attrib["name"] in itemNames:
+		itemNames = set()
+		for itemEl in styleEl.findall("item"):
+			name = itemEl.attrib.get("name")
+			if name is None:
+				continue
+			if name in itemNames:
 				dupes.append([styleEl, itemEl])
 			else:
-				itemNames.append(itemEl.attrib["name"])
+				itemNames.add(name)
 	
 	#Delete all duplicates from the tree
 	for dupe in dupes:
@@ -546,10 +827,41 @@ def hackRemoveDuplicateStyleEntries(baseapkdir):
 	
 	#Save the result if any duplicates were found and removed
 	if len(dupes) > 0:
-		tree.write(os.path.join(baseapkdir, "res", "values", "styles.xml"), encoding="utf-8", xml_declaration=True)
+		tree.write(stylesxml, encoding="utf-8", xml_declaration=True)
 		print("[+] Removed " + str(len(dupes)) + " duplicate entries from styles.xml.")
 	print("")
 
+####################
+# Stream through styles.xml and check whether any <style> element has two <item> elements with
+# the same name. Returns as soon as the first duplicate is found and clears each <style> once it
+# has been checked, so the full tree is never held in memory.
+####################
+def hasDuplicateStyleEntries(stylesPath):
+	itemNames = None
+	for (event, el) in ET.iterparse(stylesPath, events=["start", "end"]):
+		if el.tag == "style":
+			if event == "start":
+				itemNames = set()
+			else:
+				itemNames = None
+				el.clear()
+		elif el.tag == "item" and event == "end" and itemNames is not None and "name" in el.attrib:
+			if el.attrib["name"] in itemNames:
+				return True
+			itemNames.add(el.attrib["name"])
+	return False
+
+####################
+# Parse an XML file and collect its namespace declarations in the same pass.
+# Returns the tree and a dict mapping namespace prefixes to URIs.
+####################
+def parseXmlWithNamespaces(xmlpath):
+	namespaces = {}
+	parser = ET.iterparse(xmlpath, events=["start-ns"])
+	for (event, node) in parser:
+		namespaces[node[0]] = node[1]
+	return (ET.ElementTree(parser.root), namespaces)
+
 ####################
 # Update AndroidManifest.xml to disable APK splitting.
 # -> Removes the "isSplitRequired" attribute of the "application" element.
@@ -559,36 +871,36 @@ def hackRemoveDuplicateStyleEntries(baseapkdir):
 def disableApkSplitting(baseapkdir):
 	print("Disabling APK splitting in AndroidManifest.xml of base APK.")
 	
-	#Load AndroidManifest.xml
-	tree = xml.etree.ElementTree.parse(os.path.join(baseapkdir, "AndroidManifest.xml"))
+	#Load AndroidManifest.xml along with its namespaces
+	manifestxml = os.path.join(baseapkdir, "AndroidManifest.xml")
+	(tree, namespaces) = parseXmlWithNamespaces(manifestxml)
 	
 	#Register the namespaces and get the prefix for the "android" namespace
-	namespaces = dict([node for _,node in xml.etree.ElementTree.iterparse(os.path.join(baseapkdir, "AndroidManifest.xml"), events=["start-ns"])])
 	for ns in namespaces:
-		xml.etree.ElementTree.register_namespace(ns, namespaces[ns])
+		ET.register_namespace(ns, namespaces[ns])
 	ns = "{" + namespaces["android"] + "}"
 	
+	#Qualified attribute names, built once rather than per lookup
+	nameAttr = ns + "name"
+	splitRequiredAttr = ns + "isSplitRequired"
+	extractNativeLibsAttr = ns + "extractNativeLibs"
+	
 	#Disable APK splitting
-	appEl = None
-	elsToRemove = []
-	for el in tree.iter():
-		if el.tag == "application":
-			appEl = el
-			if ns + "isSplitRequired" in el.attrib:
-				del el.attrib[ns + "isSplitRequired"]
-			if ns + "extractNativeLibs" in el.attrib:
-				el.attrib[ns + "extractNativeLibs"] = "true"
-		elif appEl is not None and el.tag == "meta-data":
-			if ns + "name" in el.attrib:
-				if el.attrib[ns + "name"] == "com.android.vending.splits.required":
-					elsToRemove.append(el)
-				elif el.attrib[ns + "name"] == "com.android.vending.splits":
-					elsToRemove.append(el)
-	for el in elsToRemove:
-		appEl.remove(el)
+	appEl = tree.getroot().find("application")
+	if appEl is not None:
+		if splitRequiredAttr in appEl.attrib:
+			del appEl.attrib[splitRequiredAttr]
+		if extractNativeLibsAttr in appEl.attrib:
+			appEl.attrib[extractNativeLibsAttr] = "true"
+		elsToRemove = []
+		for el in appEl.findall("meta-data"):
+			if el.attrib.get(nameAttr) in ["com.android.vending.splits.required", "com.android.vending.splits"]:
+				elsToRemove.append(el)
+		for el in elsToRemove:
+			appEl.remove(el)
 	
 	#Save the updated AndroidManifest.xml
-	tree.write(os.path.join(baseapkdir, "AndroidManifest.xml"), encoding="utf-8", xml_declaration=True)
+	tree.write(manifestxml, encoding="utf-8", xml_declaration=True)
 	print("")
 
 ####################
@@ -598,54 +910,87 @@ def enableUserCerts(apkfile):
 	#Create a separate temp directory to work from
 	print("Patching APK to enable support for user-installed CA certificates.")
 	with tempfile.TemporaryDirectory() as tmppath:
-		#Extract the APK
+		#Extract the APK, only the manifest and resources are modified so leave the dex files as they are
 		apkdir = os.path.join(tmppath, apkfile.split(os.sep)[-1][:-4])
 		apkname = apkdir.split(os.sep)[-1] + ".apk"
-		ret = runApkTool(["d", apkfile, "-o", apkdir])
+		ret = runApkTool(["d", "-s", apkfile, "-o", apkdir])
 		if ret.returncode != 0:
-			print("Error: Failed to run 'apktool d " + apkfile + " -o " + apkdir + "'.\nRun with --debug-output for more information.")
+			print("Error: Failed to run 'apktool d -s " + apkfile + " -o " + apkdir + "'.\nRun with --debug-output for more information.")
 			sys.exit(1)
 		
-		#Load AndroidManifest.xml and check for or create the networkSecurityConfig attribute
-		tree = xml.etree.ElementTree.parse(os.path.join(apkdir, "AndroidManifest.xml"))
-		namespaces = dict([node for _,node in xml.etree.ElementTree.iterparse(os.path.join(apkdir, "AndroidManifest.xml"), events=["start-ns"])])
-		for ns in namespaces:
-			xml.etree.ElementTree.register_namespace(ns, namespaces[ns])
-		ns = "{" + namespaces["android"] + "}"
-		for el in tree.findall("application"):
-			el.attrib[ns + "networkSecurityConfig"] = "@xml/network_security_config"
-		tree.write(os.path.join(apkdir, "AndroidManifest.xml"), encoding="utf-8", xml_declaration=True)
-		
-		#Create a network security config file
-		fh = open(os.path.join(apkdir, "res", "xml", "network_security_config.xml"), "wb")
-		fh.write("<?xml version=\"1.0\" encoding=\"utf-8\" ?><network-security-config><base-config><trust-anchors><certificates src=\"system\" /><certificates src=\"user\" /></trust-anchors></base-config></network-security-config>".encode("utf-8"))
-		fh.close()
+		#Add the network security config
+		addNetworkSecurityConfig(apkdir)
 		
 		#Rebuild and sign the APK
+		builtapk = os.path.join(apkdir, "dist", apkname)
 		ret = runApkTool(["b", apkdir])
 		if ret.returncode != 0:
 			print("Error: Failed to run 'apktool b " + apkdir + "'.\nRun with --debug-output for more information.")
 			sys.exit(1)
 		ret = subprocess.run([
 				"jarsigner", "-sigalg", "SHA1withRSA", "-digestalg", "SHA1", "-keystore",
-				os.path.realpath(os.path.join(os.path.realpath(__file__), "..", "data", "patch-apk.keystore")),
-				"-storepass", "patch-apk", os.path.join(apkdir, "dist", apkname), "patch-apk-key"],
+				KEYSTORE_PATH,
+				"-storepass", "patch-apk", builtapk, "patch-apk-key"],
 			stdout=getStdout()
 		)
 		if ret.returncode != 0:
 			print("Error: Failed to run 'jarsigner -sigalg SHA1withRSA -digestalg SHA1 -keystore " +
-				os.path.realpath(os.path.join(os.path.realpath(__file__), "..", "data", "patch-apk.keystore")) +
-				"-storepass patch-apk " + os.path.join(apkdir, "dist", apkname) + "patch-apk-key'.\nRun with --debug-output for more information.")
+				KEYSTORE_PATH +
+				"-storepass patch-apk " + builtapk + "patch-apk-key'.\nRun with --debug-output for more information.")
 			sys.exit(1)
 		
 		#Zip align the new APK
 		os.remove(apkfile)
-		ret = subprocess.run(["zipalign", "4", os.path.join(apkdir, "dist", apkname), apkfile], stdout=getStdout())
+		ret = subprocess.run(["zipalign", "-p", "4", builtapk, apkfile], stdout=getStdout())
 		if ret.returncode != 0:
-			print("Error: Failed to run 'zipalign 4 " + os.path.join(apkdir, "dist", apkname) + " " + apkfile + "'.\nRun with --debug-output for more information.")
+			print("Error: Failed to run 'zipalign -p 4 " + builtapk + " " + apkfile + "'.\nRun with --debug-output for more information.")
 			sys.exit(1)
 	print("")
 
+####################
+# Add a network security config that trusts user-installed CA certs to an APK extracted with apktool.
+####################
+def addNetworkSecurityConfig(apkdir):
+	#Set the networkSecurityConfig attribute in AndroidManifest.xml
+	setNetworkSecurityConfig(os.path.join(apkdir, "AndroidManifest.xml"))
+	
+	#Create a network security config file
+	os.makedirs(os.path.join(apkdir, "res", "xml"), exist_ok=True)
+	fh = open(os.path.join(apkdir, "res", "xml", "network_security_config.xml"), "wb")
+	fh.write("<?xml version=\"1.0\" encoding=\"utf-8\" ?><network-security-config><base-config><trust-anchors><certificates src=\"system\" /><certificates src=\"user\" /></trust-anchors></base-config></network-security-config>".encode("utf-8"))
+	fh.close()
+
+####################
+# Set the networkSecurityConfig attribute of the <application> element in AndroidManifest.xml,
+# adding it if necessary. Only one attribute changes so the <application> start tag is patched in
+# place rather than parsing and re-serialising the whole manifest.
+####################
+def setNetworkSecurityConfig(manifestxml):
+	fh = open(manifestxml, "rb")
+	data = fh.read()
+	fh.close()
+	
+	#Get the prefix for the "android" namespace and find the <application> start tag
+	prefix = re.search(rb'xmlns:([\w.-]+)="http://schemas.android.com/apk/res/android"', data)
+	appTag = re.search(rb'<application\b(?:[^>"]|"[^"]*")*>', data)
+	if prefix is None or appTag is None:
+		print("Error: Failed to find the <application> element or android namespace in " + manifestxml + ", unable to enable support for user-installed CA certificates.")
+		sys.exit(1)
+	attr = prefix.group(1) + b":networkSecurityConfig"
+	value = b'"@xml/network_security_config"'
+	
+	#Replace the attribute value if it's already set, otherwise add the attribute
+	tag = appTag.group(0)
+	if re.search(rb"\s" + re.escape(attr) + rb"\s*=", tag) is not None:
+		tag = re.sub(rb"(\s" + re.escape(attr) + rb'\s*=\s*)"[^"]*"', lambda m: m.group(1) + value, tag)
+	else:
+		tag = b"<application " + attr + b"=" + value + tag[len(b"<application"):]
+	data = data[:appTag.start()] + tag + data[appTag.end():]
+	
+	fh = open(manifestxml, "wb")
+	fh.write(data)
+	fh.close()
+
 ####################
 # Main
 ####################